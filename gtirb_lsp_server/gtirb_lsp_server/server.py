@@ -20,7 +20,10 @@
 # reflect the position or policy of the Government and no official
 # endorsement should be inferred.
 
+import array
 import asyncio
+import bisect
+import collections
 import tempfile
 import hashlib
 import base64
@@ -29,6 +32,7 @@ import logging
 import os
 import re
 import uuid
+import weakref
 from typing import Dict, List, Optional, Set, Tuple, Union
 from urllib.parse import urlparse, unquote
 
@@ -65,6 +69,7 @@ from pygls.lsp.types import (
     Range,
     ReferenceOptions,
     ReferenceParams,
+    TextDocumentPositionParams,
 )
 
 from pygls.lsp.types import TextDocumentItem
@@ -72,7 +77,9 @@ from pygls.lsp.types import TextDocumentItem
 from pydantic import BaseModel
 from concurrent.futures import Future
 import importlib
+import itertools
 import sys
+import threading
 
 # # Might be useful at some point but keeping commented now to avoid hurting our test coverage.
 # #
@@ -99,6 +106,9 @@ DEFAULT_PORT = 3036
 DEFAULT_TCP_FLAG = False
 DEFAULT_STDIO_FLAG = True
 
+# Extensions of the listing files this server indexes.
+LISTING_EXTENSIONS = frozenset({".view"})
+
 StringList = List[str]
 LocationList = List[Location]
 
@@ -118,6 +128,23 @@ current_indexes = {}
 # Offsets with pending edits.
 modified_blocks = {}
 
+#
+# Split lines of recently used documents: (version, source length, lines).
+current_lines_cache = collections.OrderedDict()
+LINES_CACHE_SIZE = 16
+
+#
+# Generation of the most recent open of each document being indexed or indexed.
+# Indexes are only published for the current generation, under index_lock.
+index_generations = {}
+index_generation_counter = itertools.count()
+index_lock = threading.Lock()
+
+#
+# Edits made to documents while they are being indexed, replayed onto the index
+# when it is published.
+pending_changes = {}
+
 #
 # Locations for gtirbfile and indexing (json) for each document
 # For a remote-mode server they don't have a fixed location
@@ -266,6 +293,10 @@ def get_symbol_by_referent(ir, uuid):
     return None
 
 
+# Prototype tables for each loaded IR, dropped when the IR is rewritten.
+prototype_tables_by_ir = weakref.WeakKeyDictionary()
+
+
 def load_prototype_table(ir, types, c_str):
     """Load a table of prototypes from aux data, if possible"""
     aux_data: gtirb.AuxData = ir.modules[0].aux_data
@@ -325,6 +356,26 @@ def all_symbolic_expression_symbols(ir: gtirb) -> Set[Tuple[int, gtirb.Symbol]]:
     }
 
 
+# Symbolic expression addresses of each loaded IR, by symbol UUID. Only plain
+# values are stored, so the IR can still be collected once its document closes.
+symbolic_references_by_ir = weakref.WeakKeyDictionary()
+
+
+def symbolic_references_by_uuid(ir: gtirb) -> Dict[uuid.UUID, List[int]]:
+    """Return the addresses of all symbolic expressions, keyed by the UUID of their symbol"""
+    by_uuid = symbolic_references_by_ir.get(ir)
+    if by_uuid is None:
+        by_uuid = collections.defaultdict(list)
+        for (address, symbol) in sorted(
+            all_symbolic_expression_symbols(ir), key=lambda pair: pair[0]
+        ):
+            if symbol:
+                by_uuid[symbol.uuid].append(address)
+        by_uuid = dict(by_uuid)
+        symbolic_references_by_ir[ir] = by_uuid
+    return by_uuid
+
+
 def symbolic_references(
     ir: gtirb, symbols: Union[gtirb.Symbol, List[gtirb.Symbol]]
 ) -> List[Tuple[int, gtirb.Symbol]]:
@@ -332,16 +383,17 @@ def symbolic_references(
     Return a list of all matching symbols and their addresses
     from the set of all symbolic expressions
     """
+    by_uuid = symbolic_references_by_uuid(ir)
     if isinstance(symbols, gtirb.Symbol):
-        uuid = symbols.uuid
-        return filter(
-            lambda pair: pair[1] and pair[1].uuid == uuid, all_symbolic_expression_symbols(ir)
-        )
-    else:
-        uuids = list(map(lambda s: s.uuid, symbols))
-        return filter(
-            lambda pair: pair[1] and pair[1].uuid in uuids, all_symbolic_expression_symbols(ir)
-        )
+        symbols = [symbols]
+    symbols_by_uuid = {}
+    for symbol in symbols:
+        symbols_by_uuid.setdefault(symbol.uuid, symbol)
+    return [
+        (address, symbol)
+        for symbol_uuid, symbol in symbols_by_uuid.items()
+        for address in by_uuid.get(symbol_uuid, ())
+    ]
 
 
 def offsets_at_references(
@@ -362,15 +414,20 @@ def offsets_at_references(
 
 def first_line_for_uuid(offset_by_line: Dict[int, gtirb.Offset], uuid: uuid.UUID) -> Optional[int]:
     """Return the first line (lowest numerically) where the offset matches the given UUID"""
-    lines = sorted(
-        map(
-            lambda pair: pair[0],
-            filter(lambda pair: pair[1].element_id.uuid == uuid, offset_by_line.items()),
-        )
+    return min(
+        (line for line, offset in offset_by_line.items() if offset.element_id.uuid == uuid),
+        default=None,
     )
-    if len(lines) > 0:
-        return lines[0]
-    return None
+
+
+def first_lines_by_uuid(offset_by_line: Dict[int, gtirb.Offset]) -> Dict[uuid.UUID, int]:
+    """Return a map from each block UUID in the index to the first line for that block"""
+    first_lines = {}
+    for line, offset in offset_by_line.items():
+        block_uuid = offset.element_id.uuid
+        if line < first_lines.get(block_uuid, line + 1):
+            first_lines[block_uuid] = line
+    return first_lines
 
 
 def block_lines(line_by_offset: Dict[gtirb.Offset, int], block: gtirb.ByteBlock) -> List[int]:
@@ -402,7 +459,7 @@ def block_text(
 
 def symbol_for_name(ir: gtirb, name: str) -> Optional[gtirb.Symbol]:
     """Return the GTIRB symbol whose name matches the given string"""
-    return next(map(lambda s: s, filter(lambda s: s.name == name, ir.modules[0].symbols)), None)
+    return next(ir.modules[0].symbols_named(name), None)
 
 
 def function_uuid_for_name(ir: gtirb, name: str) -> Optional[uuid.UUID]:
@@ -418,24 +475,45 @@ def function_uuid_for_name(ir: gtirb, name: str) -> Optional[uuid.UUID]:
 #
 # chars to strip out so as to leave a line consisting of actual tokens
 delims = ["+", "-", "[", "]", ":", "{", "}", "*", ",", "(", ")"]
+delims_table = str.maketrans({ch: " " for ch in delims})
+# Delimiters and whitespace both end a token
+token_breaks = frozenset(delims + list(" \t\n\r\f\v"))
 
 
 def replace_delims(line):
     """Return the given line with all delimiters replaced with spaces"""
-    for ch in delims:
-        line = line.replace(ch, " ")
-    return line
+    return line.translate(delims_table)
 
 
 def isolate_token(line: str, pos: int) -> str:
     """Return the token found at the given line and character number"""
     if pos < 0 or pos >= len(line):
         return ""
-    p = re.compile("[^ \t\n\r\f\v]+")
-    for m in p.finditer(replace_delims(line)):
-        if pos >= m.start() and pos <= m.start() + len(m.group()):
-            return m.group()
-    return ""
+    # Scan outwards from pos; a cursor just past the end of a token selects it.
+    end = pos
+    while end < len(line) and line[end] not in token_breaks:
+        end += 1
+    start = pos
+    while start > 0 and line[start - 1] not in token_breaks:
+        start -= 1
+    return line[start:end]
+
+
+def document_lines(document: Document) -> StringList:
+    """Return the lines of DOCUMENT, only splitting its source again if it has changed"""
+    source = document.source
+    cached = current_lines_cache.get(document.uri)
+    if cached is None or cached[0] != document.version or cached[1] != len(source):
+        cached = (document.version, len(source), source.splitlines())
+        current_lines_cache[document.uri] = cached
+        if len(current_lines_cache) > LINES_CACHE_SIZE:
+            current_lines_cache.popitem(last=False)
+    current_lines_cache.move_to_end(document.uri)
+    return cached[2]
+
+
+# The address comment ending each listing line of code or data.
+ADDRESS_COMMENT_RE = re.compile("# EA: (0x[0-9a-f]+)$")
 
 
 def preceding_function_line(current_lines: StringList, name: str, line: int) -> Optional[int]:
@@ -443,13 +521,14 @@ def preceding_function_line(current_lines: StringList, name: str, line: int) ->
     Return the line where the named function is declared,
     searching backwards from the given line.
     """
-    logger.debug(f"preceding_function_line(asm, '{name}', {line})")
-    name_re = re.compile(name + ":")
-    addr_re = re.compile("# EA: (0x[0-9a-f]+)$")
+    logger.debug("preceding_function_line(asm, '%s', %s)", name, line)
+    # Match the symbol name literally, it may contain regex metacharacters.
+    label = name + ":"
     for i in range(1, line):
-        if name_re.search(current_lines[line - i]):
+        text = current_lines[line - i]
+        if label in text:
             return line - i
-        elif addr_re.search(current_lines[line - i]):
+        elif "# EA: " in text and ADDRESS_COMMENT_RE.search(text):
             return None
     return None
 
@@ -459,37 +538,35 @@ def get_line_offset(ir: gtirb, current_lines: StringList) -> List[Tuple[int, Tup
     list of line numbers and associated offsets."""
 
     # Process the assembly code file to create a list of (address, line_number).
-    addr_re = re.compile("# EA: (0x[0-9a-f]+)$")
-    address_lines = list(
-        map(
-            lambda pair: (int(pair[0], 16), pair[1]),
-            filter(
-                lambda x: x[0],
-                map(
-                    lambda line: ((addr_re.search(line[1]) or [None, None])[1], line[0]),
-                    enumerate(current_lines),
-                ),
-            ),
-        )
+    addr_search = ADDRESS_COMMENT_RE.search
+    address_matches = (
+        (line_number, addr_search(line))
+        for line_number, line in enumerate(current_lines)
+        if "# EA: " in line
     )
+    address_lines = [(int(m[1], 16), line_number) for line_number, m in address_matches if m]
     address_lines.sort(key=lambda x: x[0])
 
-    # Process the gtirb file to create a list of (address, UUID).
+    # Map each listing address inside a block to (UUID, displacement).
+    addresses = array.array("Q", (address for address, _ in address_lines))
     address_to_uuid_displacement = {}
     for block in ir.byte_blocks:
-        if block.address:
-            for i in range(block.size):
-                address_to_uuid_displacement[block.address + i] = (block.uuid, i)
+        block_address = block.address
+        if block_address:
+            block_uuid = block.uuid
+            start = bisect.bisect_left(addresses, block_address)
+            end = bisect.bisect_left(addresses, block_address + block.size, start)
+            for address in addresses[start:end]:
+                address_to_uuid_displacement[address] = (block_uuid, address - block_address)
         else:
             logger.warning("Block has no address, gtirb file may be defective.")
 
     # Walk the lists building up a map of line_number <-> (uuid, offset).
     # Lowest address in file should be in a block.
-    line_offsets = []
-    for (address, line_number) in address_lines:
-        line_offsets += [(line_number, address_to_uuid_displacement[address])]
-
-    return line_offsets
+    return [
+        (line_number, address_to_uuid_displacement[address])
+        for (address, line_number) in address_lines
+    ]
 
 
 def line_offsets_to_maps(
@@ -517,102 +594,254 @@ class UUIDEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def ensure_index(text_document: TextDocumentItem) -> Tuple[bool, bool]:
+# On disk, "lines" holds flat (line, index into "uuids", displacement) triples.
+def line_offsets_to_json(
+    line_offsets: List[Tuple[int, Tuple[uuid.UUID, int]]], sources: Optional[Dict] = None
+) -> str:
     """
-    Create (or load from file if possible) an offset/line index for the given listing file.
+    Serialize LINE_OFFSETS to the compact JSON form of the on-disk index.
+    SOURCES, if given, fingerprints the files the index was built from.
+    """
+    uuid_indexes = {}
+    lines = []
+    for (line, (block_uuid, displacement)) in line_offsets:
+        lines.extend((line, uuid_indexes.setdefault(block_uuid, len(uuid_indexes)), displacement))
+    index = {
+        "sources": sources,
+        "uuids": [block_uuid.hex for block_uuid in uuid_indexes],
+        "lines": lines,
+    }
+    return json.dumps(index, separators=(",", ":"))
+
+
+def line_offsets_from_json(
+    data: Union[str, bytes], sources: Optional[Dict] = None
+) -> List[Tuple[int, Tuple[uuid.UUID, int]]]:
+    """
+    Deserialize line offsets written by line_offsets_to_json.
+    If SOURCES is given it must match the fingerprint stored with the index.
+    """
+    index = json.loads(data)
+    if not isinstance(index, dict):
+        raise ValueError("index file is not in the current format")
+    if sources is not None and index.get("sources") != sources:
+        raise ValueError("index file was built from different sources")
+    uuids = [uuid.UUID(hex=uuid_hex) for uuid_hex in index["uuids"]]
+    lines = index["lines"]
+    return [
+        (line, (uuids[uuid_index], displacement))
+        for line, uuid_index, displacement in zip(lines[0::3], lines[1::3], lines[2::3])
+    ]
+
+
+def write_file_atomically(path: str, data: Union[str, bytes]) -> None:
+    """
+    Write DATA to PATH via a temporary file in the same directory, so that an
+    interrupted write never leaves a truncated file behind to be reused later.
+    """
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, "wb" if isinstance(data, bytes) else "w") as outfile:
+            outfile.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def index_is_current(indexfile: str, source_files: List[Optional[str]]) -> bool:
+    """
+    Return True iff INDEXFILE exists and is no older than any of the SOURCE_FILES.
+    Source files that are not available locally (e.g. the listing of a remote
+    client) are skipped.
+    """
+    try:
+        index_mtime = os.path.getmtime(indexfile)
+    except OSError:
+        return False
+    return all(
+        index_mtime >= os.path.getmtime(path)
+        for path in source_files
+        if path is not None and os.path.exists(path)
+    )
+
+
+def ensure_index(
+    text_document: TextDocumentItem,
+    gtirbfile: str,
+    jsonfile: str,
+    current_lines: Optional[StringList] = None,
+    generation: Optional[int] = None,
+) -> Tuple[bool, bool]:
+    """
+    Create (or load from file JSONFILE if possible) an offset/line index for the
+    given listing file against the GTIRB file GTIRBFILE.
+    CURRENT_LINES, if given, are the already split lines of the listing.
+    GENERATION, if given, is the open of the document this index is for; the
+    index is discarded if the document has been closed or reopened meanwhile.
     Return a tuple of
     [0] True if indexing OK and
     [1] True iff reusing a previously created index
     """
-    logger.debug(f"ensure_index({text_document.uri})")
+    logger.debug("ensure_index(%s)", text_document.uri)
     reused_index = False
 
     try:
-        gtirbfile = gtirbfile_path_map[text_document.uri]
-        jsonfile = indexfile_path_map[text_document.uri]
         ir = gtirb.IR.load_protobuf(gtirbfile)
-        current_gtirbs[text_document.uri] = ir
     except Exception as inst:
         logger.error(inst)
         logger.error(f"Unable to load gtirb file {gtirbfile}")
         return (False, False)
 
+    if current_lines is None:
+        current_lines = text_document.text.splitlines()
+    # Fingerprint the sources, a remote client's listing has no mtime to check.
+    sources = {"gtirb_size": os.path.getsize(gtirbfile), "listing_lines": len(current_lines)}
+
     line_offsets = None
-    if os.path.exists(jsonfile):
+    asmfile = parse_listing_uri(text_document.uri)[0]
+    if index_is_current(jsonfile, [gtirbfile, asmfile]):
         try:
-            logger.debug(f"Loading (line-number,offset(UUID,int)) map from JSON file: {jsonfile}")
-            # Convert UUIDs back from hex to UUIDs.
-            line_offsets = list(
-                map(
-                    lambda el: (el[0], (uuid.UUID(hex=el[1][0]), el[1][1])),
-                    json.load(open(jsonfile, "r")),
-                )
-            )
+            logger.debug("Loading (line-number,offset(UUID,int)) map from JSON file: %s", jsonfile)
+            # Indexes in an older format or from other sources are rebuilt below.
+            with open(jsonfile, "rb") as infile:
+                line_offsets = line_offsets_from_json(infile.read(), sources)
             reused_index = True
         except Exception:
             logger.info(f"Failed to load JSON file: {jsonfile}")
             line_offsets = None
 
     if line_offsets is None:
-        logger.debug(f"Populating (line-number,offset(UUID,int)) map to JSON file: {jsonfile}")
-        current_lines = text_document.text.splitlines()
-        line_offsets = get_line_offset(ir, current_lines)
-
-        # Store the resulting map into a JSON file.
-        logger.debug(f"line_offsets => {line_offsets}")
-        json.dump(line_offsets, open(jsonfile, "w"), cls=UUIDEncoder)
+        logger.debug("Populating (line-number,offset(UUID,int)) map to JSON file: %s", jsonfile)
+        try:
+            line_offsets = get_line_offset(ir, current_lines)
+        except Exception as inst:
+            logger.error(inst)
+            logger.error(f"Unable to index {text_document.uri} against {gtirbfile}")
+            return (False, False)
+        logger.debug("line_offsets => %s", line_offsets)
 
     # Create maps from line_uuids going both ways.
-    current_indexes[text_document.uri] = line_offsets_to_maps(ir, line_offsets)
+    index = line_offsets_to_maps(ir, line_offsets)
+    with index_lock:
+        published = generation is None or index_generations.get(text_document.uri) == generation
+        if published:
+            current_indexes[text_document.uri] = index
+            current_gtirbs[text_document.uri] = ir
+            # Catch up with the edits made while indexing.
+            changes = pending_changes.pop(text_document.uri, None)
+            if changes:
+                record_changes(text_document.uri, changes)
+
+    # Store the resulting map into a JSON file, even for a closed document.
+    if not reused_index:
+        try:
+            write_file_atomically(jsonfile, line_offsets_to_json(line_offsets, sources))
+        except OSError as inst:
+            logger.error(inst)
+            logger.error(f"Unable to store index file {jsonfile}")
+
+    if not published:
+        logger.debug("Discarding index of closed document %s", text_document.uri)
+        return (False, False)
     return (True, reused_index)
 
 
 def address_to_line(ir: gtirb, line_by_offset: Dict[int, gtirb.Offset], address: int) -> int:
     """Return the listing line number matching the given address"""
     for block in ir.modules[0].byte_blocks_on(address):
-        offset = gtirb.Offset(
-            element_id=ir.get_by_uuid(block.uuid), displacement=(address - block.address)
-        )
+        offset = gtirb.Offset(element_id=block, displacement=(address - block.address))
         # Some blocks may not map to a line. Use the first one that does.
         line = line_by_offset.get(offset)
         if line:
             return line
 
 
+def edited_line_after_change(
+    line: int, start_line: int, start_char: int, end_line: int, new_lines: int
+) -> Optional[int]:
+    """
+    Return where LINE, one of the lines START_LINE to END_LINE touched by an edit
+    starting at column START_CHAR and inserting NEW_LINES line breaks, ends up.
+    Return None if the edit removed the line.
+    """
+    if line == start_line and start_char > 0:
+        # The start of the line is kept in place.
+        return line
+    if line == end_line:
+        # The rest of the line follows the inserted text, unless it was joined
+        # to the kept start of the first line.
+        return start_line + new_lines if start_char == 0 or new_lines > 0 else None
+    if line - start_line < new_lines:
+        # Replaced lines keep their offsets in order.
+        return line
+    return None
+
+
 def apply_changes_to_indexes(
     offset_by_line: Dict[int, gtirb.Offset],
     line_by_offset: Dict[gtirb.Offset, int],
-    changes: List[Tuple[int, int, str]],
-) -> Tuple[Dict[int, gtirb.Offset], Dict[gtirb.Offset, int], Set[gtirb.Offset]]:
-    """Update indexes to reflect edits"""
-
-    for start, end, text in changes:
-        new_count = len(text.splitlines())
-        old_count = (end + 1) - start
-        growth = new_count - old_count
-
-        def update_line(line):
-            if line < (start + min(new_count, old_count)):
-                return line
-            if line > end:
-                return line + growth
-            return None
+    changes: List[Tuple[int, int, int, str]],
+) -> Tuple[Dict[int, gtirb.Offset], Dict[gtirb.Offset, int]]:
+    """
+    Update indexes to reflect edits. Each change replaces the text from column
+    START_CHAR of line START_LINE up to line END_LINE with TEXT. Lines after the
+    edit move with it, see edited_line_after_change for the lines it touches.
+    """
 
-        new_offset_by_line = {}
-        new_line_by_offset = {}
+    for start_line, start_char, end_line, text in changes:
+        new_lines = text.count("\n")
+        growth = new_lines - (end_line - start_line)
+        if growth == 0:
+            # Edits that keep the number of lines leave the indexes as they are.
+            continue
+        updated = {}
+        for line, offset in offset_by_line.items():
+            if line < start_line:
+                updated[line] = offset
+            elif line > end_line:
+                updated[line + growth] = offset
+            else:
+                moved = edited_line_after_change(line, start_line, start_char, end_line, new_lines)
+                if moved is not None:
+                    updated[moved] = offset
+        offset_by_line = updated
+        line_by_offset = {offset: line for line, offset in offset_by_line.items()}
 
-        lines = sorted(offset_by_line.keys())
-        for line in range(min(lines), max(lines) + growth + 1):
-            new_line = update_line(line)
-            new_offset = offset_by_line.get(new_line)
-            if new_line and new_offset:
-                new_offset_by_line[new_line] = new_offset
-                new_line_by_offset[new_offset] = new_line
+    return (offset_by_line, line_by_offset)
+
+
+def record_changes(uri: str, changes: List[Tuple[int, int, int, str]]) -> Set[gtirb.ByteBlock]:
+    """
+    Mark the blocks on the lines touched by CHANGES to the indexed document URI
+    as modified and update its indexes to match. Each change is a tuple as taken
+    by apply_changes_to_indexes. Return the blocks that were not modified before.
+    """
+    (offset_by_line, line_by_offset) = current_indexes[uri]
+    blocks = modified_blocks.setdefault(uri, set())
+    newly_modified = set()
+    for change in changes:
+        (start_line, _, end_line, _) = change
+        for line in range(start_line, end_line + 1):
+            offset = offset_by_line.get(line)
+            logger.debug("offset %s for edit line %s", offset, line)
+            if offset and offset.element_id not in blocks:
+                newly_modified.add(offset.element_id)
+                blocks.add(offset.element_id)
+        (offset_by_line, line_by_offset) = apply_changes_to_indexes(
+            offset_by_line, line_by_offset, [change]
+        )
+    current_indexes[uri] = (offset_by_line, line_by_offset)
+    return newly_modified
 
-        offset_by_line = new_offset_by_line
-        line_by_offset = new_line_by_offset
 
-    return (new_offset_by_line, line_by_offset)
+def forget_indexing(uri: str, generation: int) -> None:
+    """Forget the open GENERATION of URI, unless the document has been reopened since."""
+    with index_lock:
+        if index_generations.get(uri) == generation:
+            del index_generations[uri]
+            pending_changes.pop(uri, None)
 
 
 def parse_listing_uri(listing_uri: str) -> Tuple[str, str]:
@@ -667,9 +896,7 @@ async def configure_path_mapping(ls: GtirbLanguageServer, text_document: TextDoc
         client_gtirbfile_uri = "file://" + gtirbfile
         result = await ls.get_gtirb_content_async(client_gtirbfile_uri)
         gtirb_bytes = result["text"].encode("utf-8")
-        with open(remote_gtirbfile, "wb") as file_to_save:
-            gtirb_data = base64.decodebytes(gtirb_bytes)
-            file_to_save.write(gtirb_data)
+        write_file_atomically(remote_gtirbfile, base64.decodebytes(gtirb_bytes))
 
     # Store a map to use for finding the files later
     gtirbfile_path_map[text_document.uri] = remote_gtirbfile
@@ -683,7 +910,7 @@ def offset_indexed_aux_data(ir: gtirb) -> List[str]:
     for (name, value) in ir.modules[0].aux_data.items():
         if not isinstance(value.data, dict):
             continue
-        if not value.data or not isinstance(list(value.data.keys())[0], gtirb.Offset):
+        if not value.data or not isinstance(next(iter(value.data)), gtirb.Offset):
             continue
         results += [name]
     return results
@@ -710,8 +937,12 @@ async def get_line_from_address(ls: GtirbLanguageServer, *args) -> Optional[Rang
     """Get the line number for an address for a document"""
     document_uri = args[0][0]
     address_str = args[0][1]
-    logger.debug(f"Command: get_line_from_address, uri: {document_uri}")
-    if document_uri not in ls.workspace.documents or document_uri not in current_gtirbs:
+    logger.debug("Command: get_line_from_address, uri: %s", document_uri)
+    if (
+        document_uri not in ls.workspace.documents
+        or document_uri not in current_gtirbs
+        or document_uri not in current_indexes
+    ):
         ls.show_message(f" No address mapping for {document_uri}")
         return None
     try:
@@ -733,18 +964,19 @@ async def get_line_from_address(ls: GtirbLanguageServer, *args) -> Optional[Rang
     return None
 
 
+# A .globl directive, a .type directive or a label, tried in that order.
+FUNCTION_NAME_RE = re.compile(
+    r"\.globl ([A-Za-z0-9_]+)|\.type ([A-Za-z0-9_]+), @function|([A-Za-z0-9_]+):"
+)
+
+
 def parse_function_name(text: str) -> Optional[str]:
     """Parse a function name from TEXT, if possible."""
-    logger.debug(f"parse_function_name({text}")
+    logger.debug("parse_function_name(%s)", text)
 
-    GLOBL_RE: re.Pattern = re.compile(r"\.globl ([A-Za-z0-9_]+)")
-    TYPE_RE: re.Pattern = re.compile(r"\.type ([A-Za-z0-9_]+), @function")
-    FUNCTION_LABEL_RE: re.Pattern = re.compile(r"([A-Za-z0-9_]+):")
-
-    for regex in [GLOBL_RE, TYPE_RE, FUNCTION_LABEL_RE]:
-        m = regex.match(text)
-        if m:
-            return m.group(1)
+    m = FUNCTION_NAME_RE.match(text)
+    if m:
+        return m.group(m.lastindex)
     return None
 
 
@@ -753,12 +985,14 @@ def function_decompilations(ir: gtirb, name: str) -> Optional[str]:
     Return the decompilation auxdata associated with the given function NAME in IR
     as a markdown string.
     """
-    logger.debug(f"function_name_to_auxdata(IR, {name})")
+    logger.debug("function_name_to_auxdata(IR, %s)", name)
 
     result: str = ""
     aux_data: gtirb.AuxData = ir.modules[0].aux_data
-    function_uuid: uuid.UUID = function_uuid_for_name(ir, name)
     function_sources: Dict = aux_data.get("functionSources", gtirb.AuxData({}, "")).data
+    if not function_sources:
+        return None
+    function_uuid: uuid.UUID = function_uuid_for_name(ir, name)
     function_sources = function_sources.get(function_uuid, {})
     for annotation_source, text in function_sources.items():
         if text.strip():
@@ -767,6 +1001,35 @@ def function_decompilations(ir: gtirb, name: str) -> Optional[str]:
     return result.strip() if result else None
 
 
+def resolve_token(
+    ls: GtirbLanguageServer, params: TextDocumentPositionParams
+) -> Optional[Tuple[Document, StringList, str]]:
+    """
+    Return the document, its lines and the token at the position given in PARAMS,
+    or None (after telling the user why) if the document is not indexed or there
+    is no token there.
+    """
+    current_document: Document = ls.workspace.get_document(params.text_document.uri)
+
+    # Make sure the document indexes and gtirb representation are cached
+    if current_document.uri not in current_indexes or current_document.uri not in current_gtirbs:
+        ls.show_message(f"{current_document.uri} is not currently cached.")
+        return None
+
+    current_lines: StringList = document_lines(current_document)
+    current_token = ""
+    if 0 <= params.position.line < len(current_lines):
+        current_token = isolate_token(
+            current_lines[params.position.line], params.position.character
+        )
+
+    # Ensure token was found at the given position.
+    if len(current_token) == 0:
+        ls.show_message(f" no token found for {params.position.line}:{params.position.character}")
+        return None
+    return (current_document, current_lines, current_token)
+
+
 def create_gtirb_server_instance():
 
     server = GtirbLanguageServer(protocol_cls=NonTerminatingLanguageServerProtocol)
@@ -800,7 +1063,7 @@ def create_gtirb_server_instance():
         """Get the address of a symbol"""
         document_uri = args[0][0]
         symbol_name = args[0][1]
-        logger.debug(f"Command: get_address_of_symbol, uri: {document_uri}")
+        logger.debug("Command: get_address_of_symbol, uri: %s", document_uri)
         if document_uri not in ls.workspace.documents or document_uri not in current_gtirbs:
             ls.show_message(f" No address mapping for {document_uri}")
             return None
@@ -841,7 +1104,11 @@ def create_gtirb_server_instance():
     async def get_function_locations(ls: GtirbLanguageServer, *args) -> Optional[LocationList]:
         """Get a list of functions and their locations in the listing file"""
         document_uri = args[0][0]
-        if document_uri not in ls.workspace.documents or document_uri not in current_gtirbs:
+        if (
+            document_uri not in ls.workspace.documents
+            or document_uri not in current_gtirbs
+            or document_uri not in current_indexes
+        ):
             ls.show_message(f" No {document_uri} in document index")
             return None
 
@@ -857,7 +1124,8 @@ def create_gtirb_server_instance():
         # Retrieve the offsets for the URI
         (offset_by_line, line_by_offset) = current_indexes[document_uri]
 
-        # Generate a list of functions from the function entries auxdata
+        # Generate a list of functions from the function entries auxdata.
+        first_lines = first_lines_by_uuid(offset_by_line)
         gtirb_funclist = []
         function_names_data = function_names.data
         for key in function_names_data:
@@ -865,7 +1133,7 @@ def create_gtirb_server_instance():
             function_name = symbol.name
 
             # Use GTIRB to get symbol object from function name
-            definition_line = first_line_for_uuid(offset_by_line, symbol.referent.uuid)
+            definition_line = first_lines.get(symbol.referent.uuid)
 
             if definition_line:
                 tup = (function_name, definition_line, definition_line + 1)
@@ -873,7 +1141,7 @@ def create_gtirb_server_instance():
 
         # Generate a list of locations from the defintion lines
         current_document: Document = ls.workspace.get_document(document_uri)
-        current_lines: StringList = current_document.source.splitlines()
+        current_lines: StringList = document_lines(current_document)
         locations: LocationList = []
 
         for tup in gtirb_funclist:
@@ -916,7 +1184,11 @@ def create_gtirb_server_instance():
         """Get the line number for an address for a document"""
         document_uri = args[0][0]
         address_str = args[0][1]
-        if document_uri not in ls.workspace.documents or document_uri not in current_gtirbs:
+        if (
+            document_uri not in ls.workspace.documents
+            or document_uri not in current_gtirbs
+            or document_uri not in current_indexes
+        ):
             ls.show_message(f" No address mapping for {document_uri}")
             return None
 
@@ -942,7 +1214,7 @@ def create_gtirb_server_instance():
     async def get_line_address_list(ls: GtirbLanguageServer, *args) -> List[List[int]]:
         """Get a list of (line, address) pairs for every line with an instruction"""
         document_uri = args[0][0]
-        if document_uri not in ls.workspace.documents:
+        if document_uri not in ls.workspace.documents or document_uri not in current_indexes:
             ls.show_message(f" No address mapping for {document_uri}")
             return None
         offset_by_line = current_indexes[document_uri][0]
@@ -957,7 +1229,7 @@ def create_gtirb_server_instance():
     def did_change(ls: GtirbLanguageServer, params: DidChangeTextDocumentParams) -> None:
         """GTIRB listing did change notification."""
         uri = params.text_document.uri
-        logger.debug(f"Document Did Change notification, {params.text_document.uri}")
+        logger.debug("Document Did Change notification, %s", params.text_document.uri)
         ls.show_message_log(f"Document Did Change notification, {params.text_document.uri}")
 
         #
@@ -967,48 +1239,39 @@ def create_gtirb_server_instance():
             ls.show_message("Warning: GTIRB rewriting is disabled")
             return None
 
-        if uri not in modified_blocks:
-            modified_blocks[uri] = set()
+        changes = [
+            (
+                change.range.start.line,
+                change.range.start.character,
+                change.range.end.line,
+                change.text,
+            )
+            for change in params.content_changes
+        ]
+        with index_lock:
+            if uri not in current_indexes and uri in index_generations:
+                # The document is still being indexed, its index catches up on publishing.
+                pending_changes.setdefault(uri, []).extend(changes)
+                ls.show_message_log(f"Storing edit for {params.text_document.uri}")
+                return None
 
+        # Only track edits to indexed documents.
         if uri not in current_indexes:
             ls.show_message(f"document {uri} not in indexes")
             return None
-        (offset_by_line, line_by_offset) = current_indexes[uri]
-
-        # Track the blocks modified by the edit.
-        for change in params.content_changes:
-            for line in range(change.range.start.line, change.range.end.line + 1):
-                offset = offset_by_line.get(line)
-                logger.debug(f"offset {offset} for edit line {line}")
-                if offset:
-                    if offset.element_id not in modified_blocks[uri]:
-                        asm = block_text(
-                            line_by_offset,
-                            offset.element_id,
-                            ls.workspace.get_document(uri).lines,
-                        )
-                        logger.debug(f" modified block {offset.element_id} with:\n{asm}")
-                    modified_blocks[uri].add(offset.element_id)
-
-        # Update the indices to reflect the edit.
-        (offset_by_line, line_by_offset) = apply_changes_to_indexes(
-            offset_by_line,
-            line_by_offset,
-            map(
-                lambda change: (change.range.start.line, change.range.end.line + 1, change.text),
-                params.content_changes,
-            ),
-        )
 
-        current_indexes[uri] = (offset_by_line, line_by_offset)
+        # Track the blocks modified by the edit, and update the indices to reflect it.
+        for block in record_changes(uri, changes):
+            asm = block_text(
+                current_indexes[uri][1], block, document_lines(ls.workspace.get_document(uri))
+            )
+            logger.debug(" modified block %s with:\n%s", block, asm)
 
-        logger.debug(f"{len(modified_blocks[uri])} blocks for {len(params.content_changes)} edits")
+        logger.debug(
+            "%s blocks for %s edits", len(modified_blocks[uri]), len(params.content_changes)
+        )
         ls.show_message_log(f"Storing edit for {params.text_document.uri}")
 
-        # TODO: Update the lines<->offset map as the lines change.
-        # - get the affected lines from the range
-        # - update all lines in the line<->offset map appropriately
-
         # Could consider updating the spaces in time to ensure the column
         # offset of the address stays consistent.
 
@@ -1021,7 +1284,7 @@ def create_gtirb_server_instance():
         process the edits and save the modified GTIRB file.
         """
         uri = params.text_document.uri
-        logger.debug(f"Text Document Did Save notification, uri: {uri}")
+        logger.debug("Text Document Did Save notification, uri: %s", uri)
         ls.show_message_log(f"Text Document Did Save notification, uri: {uri}")
 
         #
@@ -1031,7 +1294,7 @@ def create_gtirb_server_instance():
 
             workspace = ls.workspace
             document = workspace.get_document(uri)
-            logger.debug(f"document {document} with {len(document.lines)} lines")
+            logger.debug("document %s with %s lines", document, len(document_lines(document)))
 
             if (uri not in modified_blocks) or len(modified_blocks[uri]) == 0:
                 ls.show_message(f"no pending modifications to {uri}")
@@ -1042,7 +1305,7 @@ def create_gtirb_server_instance():
                 return None
             ir = current_gtirbs[uri]
 
-            logger.debug(f"applying {len(modified_blocks[uri])} modifications to {uri}")
+            logger.debug("applying %s modifications to %s", len(modified_blocks[uri]), uri)
 
             functions = gtirb_functions.Function.build_functions(ir.modules[0])
             blocks_to_functions = {
@@ -1063,14 +1326,15 @@ def create_gtirb_server_instance():
                 return gtirb_rewriting.Patch.from_function(patch)
 
             blocks: List[gtirb.ByteBlock] = []
+            current_lines = document_lines(document)
             for block in modified_blocks[uri]:
-                asm = block_text(current_indexes[uri][1], block, document.lines)
+                asm = block_text(current_indexes[uri][1], block, current_lines)
 
                 if asm == "":
                     logger.debug("TODO: implement block deletion in gtirb-rewriting")
                     ls.show_message(f"skipping {block} with empty assembly")
                 else:
-                    logger.debug(f"rewriting {block} to asm:\n{asm}")
+                    logger.debug("rewriting %s to asm:\n%s", block, asm)
                     blocks += [block]
                     ctx.replace_at(
                         blocks_to_functions[block], block, 0, block.size, literal_patch(asm)
@@ -1079,6 +1343,8 @@ def create_gtirb_server_instance():
             try:
                 if len(blocks) > 0:
                     ctx.apply()
+                    symbolic_references_by_ir.pop(ir, None)
+                    prototype_tables_by_ir.pop(ir, None)
                     # Save gtirb, overwriting the original file
                     gtirbfile = gtirbfile_path_map[uri]
                     ir.save_protobuf(gtirbfile)
@@ -1113,60 +1379,76 @@ def create_gtirb_server_instance():
     @server.feature(TEXT_DOCUMENT_DID_OPEN)
     async def did_open(ls: GtirbLanguageServer, params: DidOpenTextDocumentParams) -> None:
         """GTIRB listing did open notification."""
-        logger.debug(f"Document Did Open notification, uri: {params.text_document.uri}")
+        logger.debug("Document Did Open notification, uri: %s", params.text_document.uri)
         ls.show_message_log(f"Document Did Open notification, uri: {params.text_document.uri}")
         ext = os.path.splitext(params.text_document.uri)[1]
 
         # This is where to check the extension
-        if ext == ".view":
-            await configure_path_mapping(ls, params.text_document)
-            index_ok, reused_index = ensure_index(params.text_document)
+        if ext in LISTING_EXTENSIONS:
+            uri = params.text_document.uri
+            # Edits from here on are queued and replayed onto the index of these lines.
+            current_lines = document_lines(ls.workspace.get_document(uri))
+            generation = next(index_generation_counter)
+            index_generations[uri] = generation
+            indexing = None
+            try:
+                await configure_path_mapping(ls, params.text_document)
+                gtirbfile = gtirbfile_path_map.get(uri)
+                jsonfile = indexfile_path_map.get(uri)
+                if gtirbfile is None or jsonfile is None:
+                    ls.show_message(f"no GTIRB found for {uri}")
+                    return
+                # Index on a worker thread so the server keeps answering requests.
+                indexing = asyncio.get_event_loop().run_in_executor(
+                    None,
+                    ensure_index,
+                    params.text_document,
+                    gtirbfile,
+                    jsonfile,
+                    current_lines,
+                    generation,
+                )
+            finally:
+                if indexing is None:
+                    forget_indexing(uri, generation)
+            index_ok, reused_index = await indexing
             if index_ok:
                 filename = os.path.split(params.text_document.uri)[1]
                 ls.show_message(f"{filename} indexing completed.")
                 if reused_index:
                     ls.show_message_log(f"re-using indexes for {filename}")
+            else:
+                forget_indexing(uri, generation)
 
     @server.feature(TEXT_DOCUMENT_DID_CLOSE)
     def did_close(ls: GtirbLanguageServer, params: DidCloseTextDocumentParams) -> None:
         """GTIRB listing did close notification."""
-        logger.debug(f"Document Did Close notification, uri: {params.text_document.uri}")
+        logger.debug("Document Did Close notification, uri: %s", params.text_document.uri)
         ls.show_message_log(f"Document Did Close notification, uri: {params.text_document.uri}")
-        if params.text_document.uri in modified_blocks:
-            del modified_blocks[params.text_document.uri]
-        if params.text_document.uri in current_indexes:
-            del current_indexes[params.text_document.uri]
-            del current_gtirbs[params.text_document.uri]
-            ls.show_message_log(
-                f"Removed document from index of open documents: {params.text_document.uri}"
-            )
+        uri = params.text_document.uri
+        # Drop everything held for the document.
+        modified_blocks.pop(uri, None)
+        current_lines_cache.pop(uri, None)
+        gtirbfile_path_map.pop(uri, None)
+        indexfile_path_map.pop(uri, None)
+        with index_lock:
+            # Indexing still in progress for this document will not publish.
+            index_generations.pop(uri, None)
+            pending_changes.pop(uri, None)
+            current_gtirbs.pop(uri, None)
+            removed = current_indexes.pop(uri, None) is not None
+        if removed:
+            ls.show_message_log(f"Removed document from index of open documents: {uri}")
 
     @server.feature(DEFINITION, DefinitionOptions())
     def get_definition(ls: GtirbLanguageServer, params: DefinitionParams) -> Optional[Location]:
         """GTIRB listing definition request."""
-        logger.debug(f"Definition request received uri: {params.text_document.uri}")
+        logger.debug("Definition request received uri: %s", params.text_document.uri)
         ls.show_message_log(f"Definition request received uri: {params.text_document.uri}")
-        current_document: Document = ls.workspace.get_document(params.text_document.uri)
-
-        # Make sure the document indexes and gtirb representation are cached
-        if (
-            current_document.uri not in current_indexes
-            or current_document.uri not in current_gtirbs
-        ):
-            ls.show_message(f"{current_document.uri} is not currently cached.")
-            return None
-
-        current_lines: StringList = current_document.source.splitlines()
-        current_token: str = isolate_token(
-            current_lines[params.position.line], params.position.character
-        )
-
-        # Ensure token was found at the given position.
-        if current_token is None or len(current_token) == 0:
-            ls.show_message(
-                f" no token found for {params.position.line}:{params.position.character}"
-            )
+        resolved = resolve_token(ls, params)
+        if resolved is None:
             return None
+        (current_document, current_lines, current_token) = resolved
 
         # Retrieve the gtirb for the URI
         ir = current_gtirbs[current_document.uri]
@@ -1179,24 +1461,22 @@ def create_gtirb_server_instance():
         ):
             ls.show_message(f" {current_token} is not defined.")
             return None
-        logger.debug(f"symbol found: {symbol}")
+        logger.debug("symbol found: %s", symbol)
 
         line = first_line_for_uuid(current_indexes[current_document.uri][0], symbol.referent.uuid)
         if line is None:
             ls.show_message(f" no definition found for {symbol.name}.")
             return None
-        logger.debug(f"line found: {line}")
+        logger.debug("line found: %s", line)
 
         line = preceding_function_line(current_lines, current_token, line)
-        definition_line: str = current_lines[line]
+        start_pos = current_lines[line].find(current_token)
 
         return Location(
             uri=current_document.uri,
             range=Range(
-                start=Position(line=line, character=definition_line.find(current_token)),
-                end=Position(
-                    line=line, character=(definition_line.find(current_token) + len(current_token))
-                ),
+                start=Position(line=line, character=start_pos),
+                end=Position(line=line, character=(start_pos + len(current_token))),
             ),
         )
 
@@ -1205,31 +1485,14 @@ def create_gtirb_server_instance():
         ls: GtirbLanguageServer, params: ReferenceParams
     ) -> Optional[List[Location]]:
         """GTIRB listing references request."""
-        logger.debug(f"References request received uri: {params.text_document.uri}")
+        logger.debug("References request received uri: %s", params.text_document.uri)
         ls.show_message_log(f"References request received uri: {params.text_document.uri}")
-        current_document: Document = ls.workspace.get_document(params.text_document.uri)
-
-        # Make sure the document indexes and gtirb representation are cached
-        if (
-            current_document.uri not in current_indexes
-            or current_document.uri not in current_gtirbs
-        ):
-            ls.show_message(f"{current_document.uri} is not currently cached.")
+        resolved = resolve_token(ls, params)
+        if resolved is None:
             return None
-
-        current_lines: StringList = current_document.source.splitlines()
-        current_token: str = isolate_token(
-            current_lines[params.position.line], params.position.character
-        )
+        (current_document, current_lines, current_token) = resolved
         locations: LocationList = []
 
-        # Ensure token was found at the given position.
-        if current_token is None or len(current_token) == 0:
-            ls.show_message(
-                f" no token found for {params.position.line}:{params.position.character}"
-            )
-            return None
-
         # Retrieve the gtirb for the URI
         ir = current_gtirbs[current_document.uri]
 
@@ -1254,19 +1517,19 @@ def create_gtirb_server_instance():
         if offset is None:
             ls.show_message(f" no offset found for line {reference_line}.")
             return None
-        logger.debug(f"offset found: {offset}")
+        logger.debug("offset found: %s", offset)
 
         references = list(symbolic_references(ir, offset.element_id.references))
         if len(references) == 0:
             ls.show_message(f" no references found for line {reference_line}.")
             return None
-        logger.debug(f"references found: {references}")
+        logger.debug("references found: %s", references)
 
         offsets_and_referenced_symbols = offsets_at_references(ir, references)
         if len(offsets_and_referenced_symbols) == 0:
             ls.show_message(f" no offsets found for {references}.")
             return None
-        logger.debug(f"offsets found: {offsets_and_referenced_symbols}")
+        logger.debug("offsets found: %s", offsets_and_referenced_symbols)
 
         # This is now lines and symbols
         lines_and_referenced_symbols = list(
@@ -1284,22 +1547,18 @@ def create_gtirb_server_instance():
         if len(lines_and_referenced_symbols) == 0:
             ls.show_message(f" no lines for offsets {offsets_and_referenced_symbols}.")
             return None
-        logger.debug(f"lines found: {lines_and_referenced_symbols}")
+        logger.debug("lines found: %s", lines_and_referenced_symbols)
 
         for (line, symbol) in lines_and_referenced_symbols:
             reference_line: str = current_lines[line]
-            token = None
-            if reference_line.find(symbol.name) > 0:
-                token = symbol.name
-            if token:
+            start_pos = reference_line.find(symbol.name)
+            if start_pos > 0:
                 locations.append(
                     Location(
                         uri=current_document.uri,
                         range=Range(
-                            start=Position(line=line, character=reference_line.find(token)),
-                            end=Position(
-                                line=line, character=(reference_line.find(token) + len(token))
-                            ),
+                            start=Position(line=line, character=start_pos),
+                            end=Position(line=line, character=(start_pos + len(symbol.name))),
                         ),
                     )
                 )
@@ -1319,15 +1578,18 @@ def create_gtirb_server_instance():
     @server.feature(HOVER, HoverOptions())
     def get_hover(ls: GtirbLanguageServer, params: HoverParams) -> Optional[Hover]:
         """GTIRB listing hover request."""
-        logger.debug(f"Hover request received uri: {params.text_document.uri}")
+        logger.debug("Hover request received uri: %s", params.text_document.uri)
         ls.show_message_log(f"Hover request received uri: {params.text_document.uri}")
-        if params.text_document.uri not in current_gtirbs:
+        if (
+            params.text_document.uri not in current_gtirbs
+            or params.text_document.uri not in current_indexes
+        ):
             ls.show_message(f" {params.text_document.uri} has not been indexed yet.")
             return None
         ir = current_gtirbs[params.text_document.uri]
         (offset_by_line, line_by_offset) = current_indexes[params.text_document.uri]
         offset = offset_by_line.get(params.position.line)
-        current_line = ls.workspace.get_document(params.text_document.uri).source.splitlines()[
+        current_line = document_lines(ls.workspace.get_document(params.text_document.uri))[
             params.position.line
         ]
 
@@ -1350,14 +1612,17 @@ def create_gtirb_server_instance():
                 token: str = isolate_token(current_line, params.position.character)
                 if len(token) > 0:
                     function_name = token[:-4] if token.endswith("@PLT") else token
-                    types = GtirbTypes(ir.modules[0])
-                    prototype_table = load_prototype_table(ir, types, c_str)
+                    prototype_table = prototype_tables_by_ir.get(ir)
+                    if prototype_table is None:
+                        types = GtirbTypes(ir.modules[0])
+                        prototype_table = load_prototype_table(ir, types, c_str)
+                        prototype_tables_by_ir[ir] = prototype_table
                     if function_name in prototype_table:
                         auxdata = prototype_table[function_name]
                         markup_kind = MarkupKind.PlainText
 
         if auxdata:
-            logger.debug(f"Returning auxdata: {auxdata}")
+            logger.debug("Returning auxdata: %s", auxdata)
             return Hover(contents=MarkupContent(kind=markup_kind, value=auxdata))
         else:
             logger.debug("No auxdata found")
@@ -139,6 +139,34 @@ async def test_get_definition_fail_no_token():
     server.did_close(closeParams)
 
 
+@pytest.mark.asyncio
+async def test_get_definition_fail_line_out_of_range():
+    """
+    Test trying to get a definition when the cursor is past the end of the listing
+    """
+    server.reset_mocks()
+
+    # Testing cursor beyond the last line
+    # - Should return None
+    cursor = [len(str(fake_document.asmtext).splitlines()) + 10, 0]
+
+    # Call server.did_open()
+    openParams = DidOpenTextDocumentParams(text_document=text_document_item)
+    await server.did_open(openParams)
+
+    # Call server.get_definition()
+    defParams = DefinitionParams(
+        text_document=text_document_item,
+        position=Position(line=cursor[0], character=cursor[1]),
+    )
+    response = server.get_definition(defParams)
+    assert response is None
+
+    # Call server.did_close()
+    closeParams = DidCloseTextDocumentParams(text_document=text_document_item)
+    server.did_close(closeParams)
+
+
 @pytest.mark.asyncio
 async def test_get_definition_fail_no_symbol():
     """
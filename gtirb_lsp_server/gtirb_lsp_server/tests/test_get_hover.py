@@ -38,6 +38,7 @@ from pygls.lsp.types import (
     Position,
 )
 
+from gtirb_lsp_server.server import current_indexes
 from gtirb_lsp_server.tests.fake_server import FakeServer, FakeDocument
 
 # Create a fake server
@@ -90,3 +91,33 @@ async def test_get_hover_success():
         text_document=TextDocumentIdentifier(uri=fake_document.document_uri)
     )
     server.did_close(closeParams)
+
+
+@pytest.mark.asyncio
+async def test_get_hover_before_index_is_ready():
+    """
+    Hover over a document whose GTIRB is loaded but whose index is not built yet
+    """
+    server.reset_mocks()
+
+    text_document_item = TextDocumentItem(
+        uri=fake_document.document_uri,
+        language_id="gtgas",
+        version=1,
+        text=str(fake_document.asmtext),
+    )
+    await server.did_open(DidOpenTextDocumentParams(text_document=text_document_item))
+
+    # Drop the index, as if indexing were still running.
+    current_indexes.pop(fake_document.document_uri)
+    hoverParams = HoverParams(
+        text_document=text_document_item,
+        position=Position(line=372, character=17),
+    )
+    assert server.get_hover(hoverParams) is None
+
+    server.did_close(
+        DidCloseTextDocumentParams(
+            text_document=TextDocumentIdentifier(uri=fake_document.document_uri)
+        )
+    )
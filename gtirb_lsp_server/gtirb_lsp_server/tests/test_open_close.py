@@ -22,17 +22,34 @@
 Test opening and closing documents of the LSP server using a mocked server instance
 """
 
+import asyncio
+import gc
 import os
+import threading
+import weakref
+import gtirb
 import pytest
 from pathlib import Path
-from unittest.mock import Mock
+from unittest.mock import Mock, call, patch
 
 from pygls.lsp.types import (
+    DidChangeTextDocumentParams,
     DidCloseTextDocumentParams,
     DidOpenTextDocumentParams,
+    Position,
+    Range,
+    TextDocumentContentChangeEvent,
     TextDocumentItem,
 )
 
+from gtirb_lsp_server.server import (
+    current_gtirbs,
+    current_indexes,
+    index_generations,
+    symbol_for_name,
+    symbolic_references,
+    symbolic_references_by_ir,
+)
 from gtirb_lsp_server.tests.fake_server import FakeServer, FakeDocument
 
 # Create a fake server
@@ -87,6 +104,95 @@ async def test_did_open_did_close():
     server.did_close(closeParams)
 
 
+@pytest.mark.asyncio
+async def test_did_open_stale_index():
+    """
+    Open the document with an index older than the GTIRB file,
+    the index should be regenerated rather than reused.
+    """
+    openParams = DidOpenTextDocumentParams(text_document=text_document_item)
+    closeParams = DidCloseTextDocumentParams(text_document=text_document_item)
+    await server.did_open(openParams)
+    server.did_close(closeParams)
+    assert index_path.exists()
+
+    # Backdate the index so that it predates the GTIRB file
+    os.utime(index_path, (0, 0))
+
+    server.reset_mocks()
+    filename = os.path.split(fake_document.document.uri)[1]
+    await server.did_open(openParams)
+    assert call(f"re-using indexes for {filename}") not in (
+        server.gtirb_server.show_message_log.call_args_list
+    )
+    assert index_path.stat().st_mtime > 0
+    server.did_close(closeParams)
+
+
+@pytest.mark.asyncio
+async def test_did_close_releases_gtirb():
+    """
+    Look up references in the document, then close it,
+    the GTIRB IR and the tables cached for it should be released.
+    """
+    uri = fake_document.document_uri
+    openParams = DidOpenTextDocumentParams(text_document=text_document_item)
+    closeParams = DidCloseTextDocumentParams(text_document=text_document_item)
+    await server.did_open(openParams)
+    ir = current_gtirbs[uri]
+    assert symbolic_references(ir, symbol_for_name(ir, "main")) is not None
+    assert ir in symbolic_references_by_ir
+
+    ir_ref = weakref.ref(ir)
+    del ir
+    server.did_close(closeParams)
+    gc.collect()
+    assert ir_ref() is None
+
+
+@pytest.mark.asyncio
+async def test_did_change_during_indexing():
+    """
+    Insert a line while the document is still being indexed,
+    the index should account for it once indexing completes.
+    """
+    uri = fake_document.document_uri
+    openParams = DidOpenTextDocumentParams(text_document=text_document_item)
+    closeParams = DidCloseTextDocumentParams(text_document=text_document_item)
+    await server.did_open(openParams)
+    expected_first_line = min(current_indexes[uri][0]) + 1
+    server.did_close(closeParams)
+
+    # Hold indexing up until the edit has been made
+    load_protobuf = gtirb.IR.load_protobuf
+    edited = threading.Event()
+
+    def slow_load_protobuf(path):
+        edited.wait(10)
+        return load_protobuf(path)
+
+    change = TextDocumentContentChangeEvent(
+        range=Range(start=Position(line=0, character=0), end=Position(line=0, character=0)),
+        range_length=0,
+        text="\n",
+    )
+    changeParams = DidChangeTextDocumentParams(
+        text_document=text_document_item, content_changes=[change]
+    )
+    with patch.object(gtirb.IR, "load_protobuf", slow_load_protobuf), patch.object(
+        server.gtirb_server, "can_rewrite", Mock(return_value=True)
+    ):
+        opening = asyncio.ensure_future(server.did_open(openParams))
+        await asyncio.sleep(0)
+        assert uri not in current_indexes
+        server.did_change(changeParams)
+        edited.set()
+        await opening
+
+    assert min(current_indexes[uri][0]) == expected_first_line
+    server.did_close(closeParams)
+
+
 @pytest.mark.asyncio
 async def test_open_fail_bad_uri():
     """
@@ -101,7 +207,12 @@ async def test_open_fail_bad_uri():
         text=str(fake_document.asmtext),
     )
 
-    # Call server.did_open()
+    # Call server.did_open(), pygls puts opened documents in the workspace first
+    # A listing without a GTIRB file is reported, and nothing is left behind for it
+    server.gtirb_server.lsp.workspace.put_document(bad_document_item)
     openParams = DidOpenTextDocumentParams(text_document=bad_document_item)
-    with pytest.raises(Exception):
-        await server.did_open(openParams)
+    await server.did_open(openParams)
+    server.gtirb_server.lsp.workspace.remove_document("bad.view")
+    server.gtirb_server.show_message.assert_called_once_with("no GTIRB found for bad.view")
+    assert "bad.view" not in index_generations
+    assert "bad.view" not in current_indexes
@@ -19,17 +19,24 @@
 # reflect the position or policy of the Government and no official
 # endorsement should be inferred.
 import json
+import os
+import tempfile
 import unittest
 from pathlib import Path
 from typing import Text
 from uuid import UUID
 
 import gtirb
+from pygls.lsp.types import TextDocumentItem
+from pygls.workspace import Document
 from gtirb_lsp_server.server import (
     UUIDEncoder,
     first_line_for_uuid,
+    first_lines_by_uuid,
     get_line_offset,
     line_offsets_to_maps,
+    line_offsets_to_json,
+    line_offsets_from_json,
     offset_indexed_aux_data,
     offset_to_auxdata,
     offset_to_predecessors,
@@ -38,6 +45,7 @@ from gtirb_lsp_server.server import (
     preceding_function_line,
     symbol_for_name,
     symbolic_references,
+    all_symbolic_expression_symbols,
     apply_changes_to_indexes,
     block_text,
     offset_to_line,
@@ -47,6 +55,14 @@ from gtirb_lsp_server.server import (
     address_to_line,
     isolate_token,
     parse_listing_uri,
+    document_lines,
+    ensure_index,
+    write_file_atomically,
+    current_gtirbs,
+    current_indexes,
+    index_generations,
+    current_lines_cache,
+    LINES_CACHE_SIZE,
 )
 
 DATA_DIR = Path(__file__).parent / "data"
@@ -59,12 +75,14 @@ def slurp(path: Path) -> Text:
 
 
 class InitialIndexTestDriver(unittest.TestCase):
-    def setUp(self):
-        self.gtirb_path = DATA_DIR / "leafnode.gtirb"
-        self.gtirb = gtirb.IR.load_protobuf(self.gtirb_path)
-        self.asm_path = DATA_DIR / "leafnode.view"
-        self.asmtext = slurp(self.asm_path)
-        self.asm = self.asmtext.splitlines()
+    @classmethod
+    def setUpClass(cls):
+        # Loading the IR dominates the run time, so only do it once.
+        cls.gtirb_path = DATA_DIR / "leafnode.gtirb"
+        cls.gtirb = gtirb.IR.load_protobuf(cls.gtirb_path)
+        cls.asm_path = DATA_DIR / "leafnode.view"
+        cls.asmtext = slurp(cls.asm_path)
+        cls.asm = cls.asmtext.splitlines()
 
     def get_current_indexes(self):
         return line_offsets_to_maps(self.gtirb, get_line_offset(self.gtirb, self.asm))
@@ -89,6 +107,20 @@ class InitialIndexTestDriver(unittest.TestCase):
             ),
         )
 
+    def test_line_offsets_json_round_trip(self):
+        line_offsets = get_line_offset(self.gtirb, self.asm)
+        self.assertEqual(line_offsets_from_json(line_offsets_to_json(line_offsets)), line_offsets)
+        # Indexes written in the old list-of-pairs format are rejected.
+        old_format = json.dumps(line_offsets[:10], cls=UUIDEncoder)
+        with self.assertRaises(ValueError):
+            line_offsets_from_json(old_format)
+        # Indexes built from different sources are rejected as stale.
+        sources = {"gtirb_size": 1, "listing_lines": len(self.asm)}
+        data = line_offsets_to_json(line_offsets, sources)
+        self.assertEqual(line_offsets_from_json(data, sources), line_offsets)
+        with self.assertRaises(ValueError):
+            line_offsets_from_json(data, dict(sources, listing_lines=len(self.asm) + 1))
+
     def test_line_offsets_to_maps(self):
         (offset_by_line, line_by_offset) = line_offsets_to_maps(
             self.gtirb, get_line_offset(self.gtirb, self.asm)
@@ -116,6 +148,15 @@ class InitialIndexTestDriver(unittest.TestCase):
         first_line = first_line_for_uuid(offset_by_line, uuid_w_line)
         self.assertTrue(isinstance(first_line, int))
 
+    def test_first_lines_by_uuid(self):
+        (offset_by_line, line_by_offset) = line_offsets_to_maps(
+            self.gtirb, get_line_offset(self.gtirb, self.asm)
+        )
+        first_lines = first_lines_by_uuid(offset_by_line)
+        for block_uuid in list(first_lines)[:100]:
+            expected = first_line_for_uuid(offset_by_line, block_uuid)
+            self.assertEqual(first_lines[block_uuid], expected)
+
     def test_preceding_function_line(self):
         func_name = "freeservers"
         func_line = 9878
@@ -156,6 +197,19 @@ class InitialIndexTestDriver(unittest.TestCase):
         self.assertTrue(isinstance(offsets[0][0], gtirb.Offset))
         self.assertTrue(isinstance(offsets[0][1], gtirb.Symbol))
 
+    def test_symbolic_references_match_all_symbolic_expressions(self):
+        symbols = list(self.gtirb.modules[0].symbols)[:50]
+        everything = all_symbolic_expression_symbols(self.gtirb)
+        for symbol in symbols:
+            expected = {pair for pair in everything if pair[1] and pair[1].uuid == symbol.uuid}
+            self.assertEqual(set(symbolic_references(self.gtirb, symbol)), expected)
+        expected = {
+            pair
+            for pair in everything
+            if pair[1] and pair[1].uuid in {symbol.uuid for symbol in symbols}
+        }
+        self.assertEqual(set(symbolic_references(self.gtirb, symbols)), expected)
+
     def test_get_line_from_address(self):
         address = int("0x41acaa", 16)
         expected_line = 27070
@@ -207,7 +261,9 @@ class InitialIndexTestDriver(unittest.TestCase):
             ["Line of new text"] * ((target_end_pair[0] + 1) - target_start_pair[0])
         )
         (new_offset_by_line, new_line_by_offset) = apply_changes_to_indexes(
-            offset_by_line, line_by_offset, [(target_start_pair[0], target_end_pair[0], new_text)]
+            offset_by_line,
+            line_by_offset,
+            [(target_start_pair[0], 0, target_end_pair[0], new_text)],
         )
         # When the size doesn't change, the same sets of lines should have offsets.
         print(f"OLD LINES: {sorted(offset_by_line.keys())}")
@@ -226,7 +282,9 @@ class InitialIndexTestDriver(unittest.TestCase):
             ["Line of new text"] * (((target_end_pair[0] + 1) - target_start_pair[0]) - 1)
         )
         (new_offset_by_line, new_line_by_offset) = apply_changes_to_indexes(
-            offset_by_line, line_by_offset, [(target_start_pair[0], target_end_pair[0], new_text)]
+            offset_by_line,
+            line_by_offset,
+            [(target_start_pair[0], 0, target_end_pair[0], new_text)],
         )
         # When the size decreases, then fewer lines should have offsets.
         print(f"OLD LINES: {sorted(offset_by_line.keys())}")
@@ -245,7 +303,9 @@ class InitialIndexTestDriver(unittest.TestCase):
             ["Line of new text"] * (((target_end_pair[0] + 1) - target_start_pair[0]) + 10)
         )
         (new_offset_by_line, new_line_by_offset) = apply_changes_to_indexes(
-            offset_by_line, line_by_offset, [(target_start_pair[0], target_end_pair[0], new_text)]
+            offset_by_line,
+            line_by_offset,
+            [(target_start_pair[0], 0, target_end_pair[0], new_text)],
         )
         print(f"OLD LINES: {sorted(offset_by_line.keys())}")
         print(f"NEW LINES: {sorted(new_offset_by_line.keys())}")
@@ -263,7 +323,62 @@ class InitialIndexTestDriver(unittest.TestCase):
             > 0
         )
         # When the size increases, then there should be the same number of lines w/offsets.
-        self.assertTrue(len(offset_by_line.keys()) > len(new_offset_by_line.keys()))
+        self.assertEqual(len(offset_by_line.keys()), len(new_offset_by_line.keys()))
+
+    def test_apply_changes_to_indexes_within_line(self):
+        (offset_by_line, line_by_offset) = line_offsets_to_maps(
+            self.gtirb, get_line_offset(self.gtirb, self.asm)
+        )
+        target_line = list(offset_by_line.keys())[100]
+        # Typing on a single line leaves every line where it was.
+        (new_offset_by_line, new_line_by_offset) = apply_changes_to_indexes(
+            offset_by_line, line_by_offset, [(target_line, 12, target_line, "mov EAX,0")]
+        )
+        self.assertEqual(new_offset_by_line, offset_by_line)
+        self.assertEqual(new_line_by_offset, line_by_offset)
+
+    def test_apply_changes_to_indexes_inserted_line(self):
+        (offset_by_line, line_by_offset) = line_offsets_to_maps(
+            self.gtirb, get_line_offset(self.gtirb, self.asm)
+        )
+        target_line = list(offset_by_line.keys())[100]
+        # Splitting a line in two moves every following line down by one.
+        (new_offset_by_line, new_line_by_offset) = apply_changes_to_indexes(
+            offset_by_line, line_by_offset, [(target_line, 4, target_line, "\nnop")]
+        )
+        for line, offset in offset_by_line.items():
+            expected_line = line + 1 if line > target_line else line
+            self.assertEqual(new_offset_by_line[expected_line], offset)
+            self.assertEqual(new_line_by_offset[offset], expected_line)
+
+    def apply_change_to_lines(self, change):
+        offset_by_line = {4: "A4", 5: "A5", 6: "B6", 7: "B7"}
+        line_by_offset = {offset: line for line, offset in offset_by_line.items()}
+        (new_offset_by_line, new_line_by_offset) = apply_changes_to_indexes(
+            offset_by_line, line_by_offset, [change]
+        )
+        self.assertEqual(new_line_by_offset, {o: line for line, o in new_offset_by_line.items()})
+        return new_offset_by_line
+
+    def test_apply_changes_to_indexes_whole_line_deleted(self):
+        # Deleting line 5 moves line 6 up into its place.
+        expected = {4: "A4", 5: "B6", 6: "B7"}
+        self.assertEqual(self.apply_change_to_lines((5, 0, 6, "")), expected)
+
+    def test_apply_changes_to_indexes_newline_at_line_start(self):
+        # A new empty line 5 pushes line 5 and everything after it down.
+        expected = {4: "A4", 6: "A5", 7: "B6", 8: "B7"}
+        self.assertEqual(self.apply_change_to_lines((5, 0, 5, "\n")), expected)
+
+    def test_apply_changes_to_indexes_newline_at_line_end(self):
+        # A new empty line 6 is inserted after line 5.
+        expected = {4: "A4", 5: "A5", 7: "B6", 8: "B7"}
+        self.assertEqual(self.apply_change_to_lines((5, 20, 5, "\n")), expected)
+
+    def test_apply_changes_to_indexes_lines_joined(self):
+        # Joining line 6 onto the end of line 5 keeps line 5's offset.
+        expected = {4: "A4", 5: "A5", 6: "B7"}
+        self.assertEqual(self.apply_change_to_lines((5, 20, 6, "")), expected)
 
     def test_block_text(self):
         (offset_by_line, line_by_offset) = line_offsets_to_maps(
@@ -282,9 +397,77 @@ class InitialIndexTestDriver(unittest.TestCase):
         self.assertEqual(function_uuid, UUID("6263d7b2-da85-49bd-8f8e-5585417a5500"))
 
 
+class EnsureIndexTestDriver(unittest.TestCase):
+    def test_ensure_index_failure_keeps_nothing_loaded(self):
+        uri = "file:///tmp/.vscode.leafnode.gtirb/x64/mismatched.view"
+        gtirbfile = str(DATA_DIR / "leafnode.gtirb")
+        jsonfile = str(DATA_DIR / "mismatched.view.json")
+        item = TextDocumentItem(uri=uri, language_id="gtgas", version=1, text="")
+        # An address that lies in no block of the IR cannot be indexed.
+        lines = ["  nop # EA: 0xdeadbeef"]
+        self.assertEqual(ensure_index(item, gtirbfile, jsonfile, lines), (False, False))
+        self.assertNotIn(uri, current_gtirbs)
+        self.assertNotIn(uri, current_indexes)
+
+    def test_ensure_index_missing_gtirb_file(self):
+        uri = "file:///tmp/.vscode.missing.gtirb/x64/missing.view"
+        item = TextDocumentItem(uri=uri, language_id="gtgas", version=1, text="")
+        gtirbfile = str(DATA_DIR / "missing.gtirb")
+        jsonfile = str(DATA_DIR / "missing.view.json")
+        self.assertEqual(ensure_index(item, gtirbfile, jsonfile, []), (False, False))
+        self.assertNotIn(uri, current_indexes)
+
+    def test_ensure_index_discards_superseded_generation(self):
+        uri = "file:///tmp/.vscode.leafnode.gtirb/x64/empty.view"
+        item = TextDocumentItem(uri=uri, language_id="gtgas", version=1, text="")
+        gtirbfile = str(DATA_DIR / "leafnode.gtirb")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jsonfile = os.path.join(tmpdir, "empty.view.json")
+            try:
+                # The document was reopened while this index was being built.
+                index_generations[uri] = 2
+                self.assertEqual(ensure_index(item, gtirbfile, jsonfile, [], 1), (False, False))
+                self.assertNotIn(uri, current_indexes)
+                # The discarded index was still stored, and is reused.
+                self.assertEqual(ensure_index(item, gtirbfile, jsonfile, [], 2), (True, True))
+                self.assertIn(uri, current_indexes)
+            finally:
+                index_generations.pop(uri)
+                current_gtirbs.pop(uri, None)
+                current_indexes.pop(uri, None)
+
+    def test_ensure_index_survives_unwritable_index_file(self):
+        uri = "file:///tmp/.vscode.leafnode.gtirb/x64/unwritable.view"
+        item = TextDocumentItem(uri=uri, language_id="gtgas", version=1, text="")
+        gtirbfile = str(DATA_DIR / "leafnode.gtirb")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jsonfile = os.path.join(tmpdir, "missing", "unwritable.view.json")
+            try:
+                self.assertEqual(ensure_index(item, gtirbfile, jsonfile, []), (True, False))
+                self.assertIn(uri, current_indexes)
+            finally:
+                current_gtirbs.pop(uri, None)
+                current_indexes.pop(uri, None)
+
+
+class WriteFileAtomicallyTestDriver(unittest.TestCase):
+    def test_write_file_atomically(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "index.json")
+            write_file_atomically(path, "old")
+            write_file_atomically(path, "new")
+            self.assertEqual(slurp(Path(path)), "new")
+            # A failed write leaves the previous contents and no temporary file.
+            with self.assertRaises(TypeError):
+                write_file_atomically(path, None)
+            self.assertEqual(slurp(Path(path)), "new")
+            self.assertEqual(os.listdir(tmpdir), ["index.json"])
+
+
 class HelloTestDriver(unittest.TestCase):
-    def setUp(self):
-        self.gtirb = gtirb.IR.load_protobuf(DATA_DIR / "hello.gtirb")
+    @classmethod
+    def setUpClass(cls):
+        cls.gtirb = gtirb.IR.load_protobuf(DATA_DIR / "hello.gtirb")
 
     def test_function_decompilations(self):
         decompilations = function_decompilations(self.gtirb, "undefined")
@@ -320,6 +503,41 @@ class ParseFunctionNameTestDriver(unittest.TestCase):
         self.assertEqual(name, "main")
 
 
+class PrecedingFunctionLineTestDriver(unittest.TestCase):
+    def test_preceding_function_line_literal_name(self):
+        # "." must not match any character, so "XL_10:" is not a match
+        lines = ["", ".L_10:", "XL_10:", "    nop"]
+        self.assertEqual(preceding_function_line(lines, ".L_10", 3), 1)
+
+        # Names with regex metacharacters must not break the search
+        lines = ["", "operator+(int):", "    nop"]
+        self.assertEqual(preceding_function_line(lines, "operator+(int)", 2), 1)
+
+        lines = ["", "foo:", "    nop  # EA: 0x401000", "    nop"]
+        self.assertIsNone(preceding_function_line(lines, "foo", 3))
+
+
+class DocumentLinesTestDriver(unittest.TestCase):
+    def test_document_lines(self):
+        document = Document("file:///lines.view", "a:\n    nop\n", version=1)
+        lines = document_lines(document)
+        self.assertEqual(lines, ["a:", "    nop"])
+        # Unchanged documents are not split again
+        self.assertIs(document_lines(document), lines)
+
+        # A new version of the document is split again
+        document = Document("file:///lines.view", "b:\n", version=2)
+        self.assertEqual(document_lines(document), ["b:"])
+
+    def test_document_lines_evicts_least_recently_used(self):
+        first = Document("file:///first.view", "a:\n", version=1)
+        document_lines(first)
+        for i in range(LINES_CACHE_SIZE):
+            document_lines(Document(f"file:///other{i}.view", "b:\n", version=1))
+        self.assertNotIn(first.uri, current_lines_cache)
+        self.assertEqual(len(current_lines_cache), LINES_CACHE_SIZE)
+
+
 class IsolateTokenTestDriver(unittest.TestCase):
     def test_isoate_token(self):
 